@@ -1,11 +1,172 @@
 import streamlit as st
 import requests
-import json
+import orjson
 import pandas as pd
 import time
+import random
+import uuid
+import hashlib
+import io
+import csv
+import tempfile
+from collections import Counter, deque
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import httpx
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.csv as pac
+except ImportError:  # Fall back to the pandas C parser and string methods
+    pa = pc = pac = None
+
+SEND_CONCURRENCY = 50
+SEND_RETRIES = 5
+# Template fetches are GETs and safe to retry on any transient status
+RETRY_STATUSES = frozenset([429, 500, 502, 503, 504])
+RETRY_BACKOFF_FACTOR = 0.5
+RETRY_BACKOFF_JITTER = 0.3
+CANCEL_GRACE_SECONDS = 5
+
+# --- HTTP Clients ---
+# Cached as resources so connection pools (and their TLS sessions to
+# graph.facebook.com) survive Streamlit reruns instead of being rebuilt.
+
+@st.cache_resource
+def get_session():
+    """Returns the shared, pooled requests session."""
+    session = requests.Session()
+    session.mount(
+        "https://",
+        HTTPAdapter(
+            pool_connections=32,
+            pool_maxsize=32,
+            max_retries=Retry(
+                total=SEND_RETRIES,
+                backoff_factor=RETRY_BACKOFF_FACTOR,
+                backoff_jitter=RETRY_BACKOFF_JITTER,
+                status_forcelist=sorted(RETRY_STATUSES),
+                respect_retry_after_header=True,
+            ),
+        ),
+    )
+    return session
+
+
+@st.cache_resource
+def get_event_loop():
+    """
+    Returns a long-lived event loop running in a background thread.
+
+    An httpx.AsyncClient's connections belong to the loop that opened them, so
+    the cached client is only ever used from this loop.
+    """
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    return loop
+
+
+@st.cache_resource
+def get_async_client():
+    """Returns the shared HTTP/2 client used for sending messages."""
+    return httpx.AsyncClient(
+        http2=True,
+        limits=httpx.Limits(max_connections=20, max_keepalive_connections=20),
+        timeout=10.0,
+    )
+
+
+class TokenBucket:
+    """
+    Paces calls to at most `rate` per second, allowing bursts of up to `burst`.
+
+    Args:
+        rate (float): Tokens added per second.
+        burst (float): Maximum number of tokens that can accumulate.
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self):
+        """Waits until a token is available and takes it."""
+        self._refill()
+        while self.tokens < 1:
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+            self._refill()
+        self.tokens -= 1
+
+    def pause(self, seconds):
+        """
+        Drains the bucket so no caller gets a token for `seconds`.
+
+        Overlapping pauses (e.g. many concurrent 429s) keep the longest one
+        rather than adding up.
+        """
+        self._refill()
+        self.tokens = min(self.tokens, -seconds * self.rate)
+
+
+def _retry_after_seconds(value, default=1.0):
+    """Parses a Retry-After header given in seconds, falling back to `default`."""
+    try:
+        return max(0.0, float(value))
+    except (TypeError, ValueError):
+        return default
+
+
+def _backoff_seconds(attempt):
+    """Exponential backoff with random jitter for the given retry attempt."""
+    return RETRY_BACKOFF_FACTOR * 2 ** attempt + random.uniform(0, RETRY_BACKOFF_JITTER)
 
 # --- API Functions ---
 
+def _fetch_template_page(session, url, headers, params):
+    """Fetches and decodes a single page of the message templates endpoint."""
+    response = session.get(url, headers=headers, params=params, timeout=10)
+    response.raise_for_status()
+    return orjson.loads(response.content)
+
+
+@st.cache_data(ttl=300, show_spinner=False)
+def _cached_templates(waba_id, token_hash, _token):
+    """
+    Fetches every page of approved template names for a WABA.
+
+    Cached for five minutes per ``(waba_id, token_hash)``; the raw token is
+    underscore-prefixed so Streamlit never hashes or stores it as a key.
+    """
+    url = f"https://graph.facebook.com/v23.0/{waba_id}/message_templates"
+    headers = {"Authorization": f"Bearer {_token}"}
+    params = {'fields': 'name,status', 'limit': 200}
+    session = get_session()
+    approved_templates = []
+    # Pages are cursor-linked, so only one can be in flight; overlap fetching
+    # the next page with filtering the current one
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        future = pool.submit(_fetch_template_page, session, url, headers, params)
+        while future is not None:
+            page = future.result()
+            # The "next" URL already carries the query string and cursor
+            next_url = page.get("paging", {}).get("next")
+            future = pool.submit(_fetch_template_page, session, next_url, headers, None) if next_url else None
+            # Filter for templates that are approved
+            approved_templates.extend(t['name'] for t in page.get("data", []) if t.get('status') == 'APPROVED')
+    return approved_templates
+
+
 def get_message_templates(token, waba_id):
     """
     Fetches message templates from the WhatsApp Business Account.
@@ -17,53 +178,35 @@ def get_message_templates(token, waba_id):
     Returns:
         list: A list of template names, or an empty list if an error occurs.
     """
-    url = f"https://graph.facebook.com/v23.0/{waba_id}/message_templates"
-    headers = {"Authorization": f"Bearer {token}"}
-    params = {'fields': 'name,status'}
+    token_hash = hashlib.sha256(token.encode()).hexdigest()
     try:
-        response = requests.get(url, headers=headers, params=params)
-        response.raise_for_status()
-        templates = response.json().get("data", [])
-        # Filter for templates that are approved
-        approved_templates = [t['name'] for t in templates if t.get('status') == 'APPROVED']
-        return approved_templates
+        return _cached_templates(waba_id, token_hash, token)
     except requests.exceptions.RequestException as e:
         st.error(f"Error fetching templates: {e}")
         return []
     except Exception as e:
         st.error(f"An unexpected error occurred: {e}")
-        st.json(response.json()) # Show the raw error from Meta
         return []
 
 
-def send_template_message(token, phone_id, to_phone_number, template_name, variables):
+def _build_template_payload(template_name, variables):
     """
-    Sends a WhatsApp template message using the Meta Graph API.
+    Builds the request body for a WhatsApp template message, minus the recipient.
 
     Args:
-        token (str): Your WhatsApp Business API token.
-        phone_id (str): Your WhatsApp Business phone number ID.
-        to_phone_number (str): The recipient's phone number.
         template_name (str): The name of the template to send.
         variables (list): A list of strings for the template's variables.
 
     Returns:
-        dict: The JSON response from the API.
+        dict: The message payload expected by the Graph API, without "to".
     """
-    url = f"https://graph.facebook.com/v19.0/{phone_id}/messages"
-    headers = {
-        "Authorization": f"Bearer {token}",
-        "Content-Type": "application/json",
-    }
-    
     components = []
     if variables:
         parameters = [{"type": "text", "text": var} for var in variables]
         components.append({"type": "body", "parameters": parameters})
 
-    data = {
+    return {
         "messaging_product": "whatsapp",
-        "to": to_phone_number,
         "type": "template",
         "template": {
             "name": template_name,
@@ -71,12 +214,199 @@ def send_template_message(token, phone_id, to_phone_number, template_name, varia
             "components": components
         },
     }
+
+
+async def _batch_limits(messages_per_second):
+    """Creates the per-batch semaphore and token bucket on the sending loop."""
+    return asyncio.Semaphore(SEND_CONCURRENCY), TokenBucket(messages_per_second, burst=messages_per_second)
+
+
+def _decode_body(response):
+    """Decodes a JSON response body, falling back to its raw text (e.g. a gateway HTML page)."""
     try:
-        response = requests.post(url, headers=headers, data=json.dumps(data))
-        response.raise_for_status()
-        return {"success": True, "data": response.json()}
-    except requests.exceptions.RequestException as e:
-        return {"success": False, "error": str(e), "details": response.json()}
+        return orjson.loads(response.content)
+    except orjson.JSONDecodeError:
+        return response.text
+
+
+async def _send_one(client, sem, bucket, url, headers, number, msg_id, body, on_sent, pending):
+    """
+    Posts a single template message, paced by the bucket and bounded by the semaphore.
+
+    POSTs are not idempotent and Graph does not deduplicate them, so only
+    rejections that mean the message was not processed are retried: 429, 503
+    with a Retry-After header, and connections that never opened. Other 5xx
+    responses (e.g. a gateway 502/504) may come after the message was
+    accepted and are reported as failures instead.
+    `msg_id` is sent as ``biz_opaque_callback_data`` so webhook status updates
+    can be matched back to this send; it is not used for deduplication.
+
+    `on_sent(number)` is called on the event loop as soon as the message is
+    accepted, or if the send is cancelled while its POST is in flight (it may
+    have been delivered). `number` stays in `pending` while this runs.
+    """
+    pending.add(number)
+    in_flight = False
+    try:
+        for attempt in range(SEND_RETRIES + 1):
+            await bucket.acquire()
+            try:
+                async with sem:
+                    in_flight = True
+                    r = await client.post(url, content=body, headers=headers)
+            except (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout):
+                in_flight = False
+                if attempt == SEND_RETRIES:
+                    raise
+                await asyncio.sleep(_backoff_seconds(attempt))
+                continue
+            retry_after = r.headers.get("Retry-After")
+            rejected = r.status_code == 429 or (r.status_code == 503 and retry_after is not None)
+            if rejected and attempt < SEND_RETRIES:
+                in_flight = False
+                # Back the whole batch off, not just this request
+                bucket.pause(_retry_after_seconds(retry_after, _backoff_seconds(attempt)))
+                continue
+            # Success is decided by the status; the body is decoded best-effort
+            result = _decode_body(r)
+            if r.status_code >= 400:
+                error = f"{r.status_code} {r.reason_phrase}"
+                return number, {"success": False, "msg_id": msg_id, "error": error, "details": result}
+            on_sent(number)
+            return number, {"success": True, "msg_id": msg_id, "data": result}
+    except httpx.HTTPError as e:
+        return number, {"success": False, "msg_id": msg_id, "error": str(e), "details": None}
+    except asyncio.CancelledError:
+        if in_flight:
+            on_sent(number)
+        raise
+    finally:
+        pending.discard(number)
+
+
+def send_all(token, phone_id, phone_numbers, template_name, variables, messages_per_second,
+             on_result, on_sent, pending):
+    """
+    Sends a WhatsApp template message to every number concurrently.
+
+    The sends run on the shared background event loop; this call blocks until
+    they all finish, invoking `on_result` from the calling thread.
+
+    Args:
+        token (str): Your WhatsApp Business API token.
+        phone_id (str): Your WhatsApp Business phone number ID.
+        phone_numbers (list): The recipients' phone numbers.
+        template_name (str): The name of the template to send.
+        variables (list): A list of strings for the template's variables.
+        messages_per_second (float): The maximum send rate.
+        on_result (callable): Called as ``on_result(done, number, response)`` as each send completes.
+        on_sent (callable): Called as ``on_sent(number)`` from the event loop thread for every
+            number that was, or may have been, delivered. Unlike `on_result`, this still runs
+            if the script run is interrupted.
+        pending (set): Holds the numbers whose sends are still running.
+
+    Returns:
+        int: The number of messages attempted.
+    """
+    url = f"https://graph.facebook.com/v19.0/{phone_id}/messages"
+    headers = {"Authorization": f"Bearer {token}", "Content-Type": "application/json"}
+    loop = get_event_loop()
+    client = get_async_client()
+    sem, bucket = asyncio.run_coroutine_threadsafe(_batch_limits(messages_per_second), loop).result()
+    # Only the recipient changes between messages, so build the rest once
+    base_payload = _build_template_payload(template_name, variables)
+    futures = []
+    for number in phone_numbers:
+        msg_id = uuid.uuid4().hex
+        body = orjson.dumps({**base_payload, "to": str(number), "biz_opaque_callback_data": msg_id})
+        futures.append(asyncio.run_coroutine_threadsafe(
+            _send_one(client, sem, bucket, url, headers, number, msg_id, body, on_sent, pending), loop
+        ))
+    done = 0
+    try:
+        for future in as_completed(futures):
+            number, response = future.result()
+            done += 1
+            on_result(done, number, response)
+    finally:
+        # The loop outlives this script run; if it is stopped or rerun mid-batch,
+        # don't let unsent messages keep going out unrecorded
+        for future in futures:
+            future.cancel()
+        # Let cancelled sends unwind so `on_sent` has recorded anything that may
+        # have gone out before the next run decides who still needs the message
+        deadline = time.monotonic() + CANCEL_GRACE_SECONDS
+        while pending and time.monotonic() < deadline:
+            time.sleep(0.05)
+    return done
+
+
+# --- CSV Loading ---
+
+CSV_CHUNK_SIZE = 50_000
+
+
+@st.cache_data(max_entries=4, show_spinner=False)
+def parse_csv(digest: str, _raw: bytes) -> pd.DataFrame:
+    """
+    Parses an uploaded contacts CSV, keeping every column as text.
+
+    Uses the multi-threaded PyArrow reader when available and otherwise the
+    pandas C parser in chunks. Reading as strings keeps phone numbers intact
+    (no integer overflow or dropped leading '+'/'0'). Cached on the content
+    `digest` (the bytes themselves are not re-hashed) and bounded so repeated
+    uploads don't pile up in memory.
+    """
+    if pac is not None:
+        # PyArrow has no "all strings" switch, so pin each header column to string
+        header = _raw.split(b'\n', 1)[0].decode('utf-8-sig')
+        column_names = next(csv.reader([header]), [])
+        table = pac.read_csv(
+            io.BytesIO(_raw),
+            read_options=pac.ReadOptions(use_threads=True, block_size=1 << 20),
+            convert_options=pac.ConvertOptions(
+                column_types={name: pa.string() for name in column_names},
+                strings_can_be_null=True,
+            ),
+        )
+        return table.to_pandas(types_mapper=pd.ArrowDtype)
+
+    chunks = pd.read_csv(io.BytesIO(_raw), dtype=str, chunksize=CSV_CHUNK_SIZE, engine='c')
+    return pd.concat(chunks, copy=False, ignore_index=True)
+
+
+# Numbers are reduced to digits only (Graph accepts them without the '+'), so
+# "+91..." and "91..." dedupe to the same recipient
+PHONE_PATTERN = r'^[1-9]\d{7,14}$'
+
+
+def select_phone_numbers(df, phone_col):
+    """
+    Returns the normalized phone numbers of the rows ticked for sending.
+
+    Filtering, reduction to digits and E.164 validation run as vectorized Arrow
+    compute kernels over the column's string buffer when pyarrow is available,
+    and as pandas string methods otherwise.
+
+    Args:
+        df (pd.DataFrame): The edited recipients, including the 'Send' column.
+        phone_col (str): The column holding phone numbers.
+
+    Returns:
+        tuple: A numpy array of valid E.164 numbers as digit strings (no
+        leading '+') and the number of selected rows dropped as invalid.
+    """
+    mask = df['Send'].fillna(False).to_numpy(dtype=bool)
+    selected = df.loc[mask, phone_col]
+    if pc is not None:
+        phones = pc.replace_substring_regex(pa.array(selected, type=pa.string()), pattern=r'\D', replacement='')
+        valid = pc.fill_null(pc.match_substring_regex(phones, PHONE_PATTERN), False)
+        valid_phones = phones.filter(valid)
+        return valid_phones.to_pandas().to_numpy(), len(phones) - len(valid_phones)
+
+    phones = selected.astype('string').str.replace(r'\D', '', regex=True)
+    valid = phones.str.match(PHONE_PATTERN).fillna(False).to_numpy(dtype=bool)
+    return phones.to_numpy()[valid], int((~valid).sum())
 
 
 # --- Streamlit App UI ---
@@ -102,12 +432,20 @@ phone_number_id = st.sidebar.text_input(
 waba_id = st.sidebar.text_input(
     "WhatsApp Business Account ID (WABA ID)", help="The ID of your WhatsApp Business Account."
 )
+messages_per_second = st.sidebar.number_input(
+    "Messages/sec", min_value=1, max_value=500, value=50,
+    help="Maximum send rate. Match your WhatsApp throughput tier (e.g. 80, 200 or 500)."
+)
 
 # Initialize session state
 if 'templates' not in st.session_state:
     st.session_state.templates = []
 if 'df_for_editing' not in st.session_state:
     st.session_state.df_for_editing = pd.DataFrame()
+# (template, variables, phone) triples already sent successfully this session
+st.session_state.setdefault('sent_cache', set())
+# Numbers whose sends are still running on the background event loop
+st.session_state.setdefault('pending_sends', set())
 
 
 # --- Main App Layout ---
@@ -145,11 +483,16 @@ with col2:
 
     if uploaded_file:
         try:
-            # If a new file is uploaded, read it and add the 'Send' column
-            if st.session_state.get('uploaded_filename') != uploaded_file.name:
-                df = pd.read_csv(uploaded_file)
-                st.session_state.uploaded_filename = uploaded_file.name
+            # If new file contents are uploaded, read them and add the 'Send' column
+            raw = uploaded_file.getvalue()
+            digest = hashlib.blake2b(raw, digest_size=16).hexdigest()
+            if st.session_state.get('uploaded_digest') != digest:
+                df = parse_csv(digest, raw)
+                st.session_state.uploaded_digest = digest
                 df.insert(0, 'Send', True) # Insert 'Send' column at the beginning
+                # Store columns Arrow-backed (contiguous buffers, including 'Send' as bool[pyarrow])
+                # so the editor diff and the Send filter run on vectorized kernels
+                df = df.convert_dtypes(dtype_backend='pyarrow' if pa is not None else 'numpy_nullable')
                 st.session_state.df_for_editing = df
         except Exception as e:
             st.error(f"Error reading CSV file: {e}")
@@ -184,54 +527,105 @@ with col2:
 # --- Send Button and Logic ---
 st.header("3. Send Messages")
 if st.button("Send to Selected Recipients", type="primary"):
-    if 'selected_template' not in locals():
+    if st.session_state.pending_sends:
+        st.warning("A previous batch is still finishing. Wait a moment and try again.")
+    elif 'selected_template' not in locals():
         st.warning("Please select a template first.")
     elif 'edited_df' not in locals() or edited_df.empty:
         st.warning("Please upload a CSV and select recipients.")
     elif 'phone_col' not in locals() or not phone_col:
          st.warning("Please select the column containing phone numbers.")
     else:
-        # Filter the dataframe for rows where 'Send' is True
-        recipients_to_send = edited_df[edited_df['Send'] == True]
+        # Normalize the phone numbers of rows where 'Send' is True
+        phone_numbers, invalid_count = select_phone_numbers(edited_df, phone_col)
+        num_selected = len(phone_numbers) + invalid_count
         
         # Add the restriction check before sending
-        if len(recipients_to_send) > 250:
-            st.error(f"Message not sent. You have selected {len(recipients_to_send)} recipients, but the maximum is 250. Please deselect some recipients and try again.")
+        if num_selected > 250:
+            st.error(f"Message not sent. You have selected {num_selected} recipients, but the maximum is 250. Please deselect some recipients and try again.")
         else:
-            # Get the phone numbers from the user-specified column
-            phone_numbers = recipients_to_send[phone_col].tolist()
+            if invalid_count:
+                st.warning(f"Skipping {invalid_count} recipient(s) without a valid phone number.")
             
             variables = [var.strip() for var in template_variables_input.split('\n') if var.strip()]
+
+            unique_numbers = pd.unique(phone_numbers)
+            if len(unique_numbers) < len(phone_numbers):
+                st.info(f"Deduped {len(phone_numbers) - len(unique_numbers)} duplicate number(s).")
+
+            # Don't resend the same message to anyone it already reached, e.g. on a double-click
+            message_key = (selected_template, tuple(variables))
+            sent_cache = st.session_state.sent_cache
+            phone_numbers = [p for p in unique_numbers if (*message_key, p) not in sent_cache]
+            if len(phone_numbers) < len(unique_numbers):
+                st.info(f"Skipping {len(unique_numbers) - len(phone_numbers)} number(s) already sent this message in this session.")
             
-            if not phone_numbers:
+            if not phone_numbers and len(unique_numbers):
+                st.warning("Every selected recipient has already been sent this message in this session. Nothing to send.")
+            elif not phone_numbers:
                 st.warning("No recipients selected. Please check the 'Send' box for at least one contact.")
             else:
                 total_recipients = len(phone_numbers)
                 st.info(f"Preparing to send '{selected_template}' to {total_recipients} recipient(s)...")
                 
                 progress_bar = st.progress(0)
-                results = []
-                
-                for i, number in enumerate(phone_numbers):
-                    with st.spinner(f"Sending to {number}... ({i+1}/{total_recipients})"):
-                        response = send_template_message(
-                            api_token, phone_number_id, str(number), selected_template, variables
-                        )
-                        results.append({"phone_number": number, "response": response})
-                    progress_bar.progress((i + 1) / total_recipients)
+                status = st.empty()
+                # Each UI update is a frontend round-trip, so refresh at most ~100 times
+                update_every = max(1, total_recipients // 100)
+
+                # Stream every result to disk and keep only counters and a few failures in memory.
+                # An anonymous temp file is removed as soon as it is closed, even if the run is interrupted.
+                results_fp = tempfile.TemporaryFile('w+b')
+                counts = Counter()
+                recent_failures = deque(maxlen=20)
+
+                def on_result(done, number, response):
+                    results_fp.write(orjson.dumps(
+                        {"phone_number": number, "response": response}, option=orjson.OPT_APPEND_NEWLINE
+                    ))
+                    if response['success']:
+                        counts['success'] += 1
+                    else:
+                        counts['failed'] += 1
+                        recent_failures.append({"phone_number": number, "response": response})
+                    if done % update_every == 0 or done == total_recipients:
+                        status.text(f"Sent {done}/{total_recipients}")
+                        progress_bar.progress(done / total_recipients)
+
+                with results_fp:
+                    # Successes are cached from the event loop, so an interrupting rerun
+                    # (e.g. a second click of Send) can't resend to them
+                    send_all(
+                        api_token, phone_number_id, phone_numbers, selected_template, variables,
+                        messages_per_second, on_result,
+                        on_sent=lambda number: sent_cache.add((*message_key, number)),
+                        pending=st.session_state.pending_sends,
+                    )
+                    # Hold the log only long enough to hand it to the download button
+                    results_fp.seek(0)
+                    results_bytes = results_fp.read()
                 
                 st.header("Sending Complete: Results")
                 
-                success_count = sum(1 for r in results if r['response']['success'])
-                st.success(f"Successfully sent messages: {success_count}/{total_recipients}")
+                st.success(f"Successfully sent messages: {counts['success']}/{total_recipients}")
                 
-                failed_messages = [r for r in results if not r['response']['success']]
-                if failed_messages:
-                    st.error(f"Failed to send messages: {len(failed_messages)}/{total_recipients}")
+                if counts['failed']:
+                    st.error(f"Failed to send messages: {counts['failed']}/{total_recipients}")
                     with st.expander("View Failed Message Details"):
-                        for failed in failed_messages:
-                            st.write(f"**Phone:** {failed['phone_number']}")
-                            st.json(failed['response'])
+                        if counts['failed'] > len(recent_failures):
+                            st.caption(f"Showing the last {len(recent_failures)} failures. Download the full results below.")
+                        # One table render instead of a write + json widget per failure
+                        fail_df = pd.DataFrame([
+                            {
+                                'phone': f['phone_number'],
+                                'error': f['response'].get('error'),
+                                'details': orjson.dumps(f['response'].get('details')).decode()[:500],
+                            }
+                            for f in recent_failures
+                        ])
+                        st.dataframe(fail_df, use_container_width=True, hide_index=True)
+
+                st.download_button("Download full results", data=results_bytes, file_name='results.jsonl')
 
 st.markdown(
     """